@@ -86,10 +86,11 @@ class Resize(object):
             h, w = rendering_images[0].shape[0:2]
             scale = self.size / min(h, w)
             dsize = (int(h * scale), int(w * scale))
-        resized_images = np.empty((len(rendering_images), dsize[0], dsize[1], rendering_images.shape[-1]))
+        # resize straight into one pre-allocated batch that keeps the input dtype
+        resized_images = np.empty((len(rendering_images), dsize[0], dsize[1], rendering_images.shape[-1]),
+                                  dtype=rendering_images.dtype)
         for img_idx, img in enumerate(rendering_images):
-            resized_images[img_idx] = cv2.resize(rendering_images[img_idx], (dsize[1], dsize[0]),
-                                                    interpolation=self.interp)
+            cv2.resize(img, (dsize[1], dsize[0]), dst=resized_images[img_idx], interpolation=self.interp)
         return resized_images
 
 
@@ -105,70 +106,70 @@ class CenterCrop(object):
         if len(rendering_images) == 0:
             return rendering_images
 
-        crop_size_c = rendering_images[0].shape[2]
-        processed_images = np.empty(shape=(0, self.img_size_h, self.img_size_w, crop_size_c))
-        for img_idx, img in enumerate(rendering_images):
-            img_height, img_width, _ = img.shape
+        # all images share one size, so the crop window is computed once and every crop
+        # is resized straight into a pre-allocated batch
+        img_height, img_width, crop_size_c = rendering_images[0].shape
+        processed_images = np.empty(shape=(len(rendering_images), self.img_size_h, self.img_size_w, crop_size_c),
+                                    dtype=rendering_images[0].dtype)
+        if bounding_box is not None:
+            bounding_box = [
+                bounding_box[0] * img_width,
+                bounding_box[1] * img_height,
+                bounding_box[2] * img_width,
+                bounding_box[3] * img_height
+            ]  # yapf: disable
+
+            # Calculate the size of bounding boxes
+            bbox_width = bounding_box[2] - bounding_box[0]
+            bbox_height = bounding_box[3] - bounding_box[1]
+            bbox_x_mid = (bounding_box[2] + bounding_box[0]) * .5
+            bbox_y_mid = (bounding_box[3] + bounding_box[1]) * .5
+
+            # Make the crop area as a square
+            square_object_size = max(bbox_width, bbox_height)
+            x_left = int(bbox_x_mid - square_object_size * .5)
+            x_right = int(bbox_x_mid + square_object_size * .5)
+            y_top = int(bbox_y_mid - square_object_size * .5)
+            y_bottom = int(bbox_y_mid + square_object_size * .5)
+
+            # If the crop position is out of the image, fix it with padding
+            pad_x_left = 0
+            if x_left < 0:
+                pad_x_left = -x_left
+                x_left = 0
+            pad_x_right = 0
+            if x_right >= img_width:
+                pad_x_right = x_right - img_width + 1
+                x_right = img_width - 1
+            pad_y_top = 0
+            if y_top < 0:
+                pad_y_top = -y_top
+                y_top = 0
+            pad_y_bottom = 0
+            if y_bottom >= img_height:
+                pad_y_bottom = y_bottom - img_height + 1
+                y_bottom = img_height - 1
+        elif img_height > self.crop_size_h and img_width > self.crop_size_w:
+            x_left = int(img_width - self.crop_size_w) // 2
+            x_right = int(x_left + self.crop_size_w)
+            y_top = int(img_height - self.crop_size_h) // 2
+            y_bottom = int(y_top + self.crop_size_h)
+        else:
+            x_left = 0
+            x_right = img_width
+            y_top = 0
+            y_bottom = img_height
 
+        for img_idx, img in enumerate(rendering_images):
             if bounding_box is not None:
-                bounding_box = [
-                    bounding_box[0] * img_width,
-                    bounding_box[1] * img_height,
-                    bounding_box[2] * img_width,
-                    bounding_box[3] * img_height
-                ]  # yapf: disable
-
-                # Calculate the size of bounding boxes
-                bbox_width = bounding_box[2] - bounding_box[0]
-                bbox_height = bounding_box[3] - bounding_box[1]
-                bbox_x_mid = (bounding_box[2] + bounding_box[0]) * .5
-                bbox_y_mid = (bounding_box[3] + bounding_box[1]) * .5
-
-                # Make the crop area as a square
-                square_object_size = max(bbox_width, bbox_height)
-                x_left = int(bbox_x_mid - square_object_size * .5)
-                x_right = int(bbox_x_mid + square_object_size * .5)
-                y_top = int(bbox_y_mid - square_object_size * .5)
-                y_bottom = int(bbox_y_mid + square_object_size * .5)
-
-                # If the crop position is out of the image, fix it with padding
-                pad_x_left = 0
-                if x_left < 0:
-                    pad_x_left = -x_left
-                    x_left = 0
-                pad_x_right = 0
-                if x_right >= img_width:
-                    pad_x_right = x_right - img_width + 1
-                    x_right = img_width - 1
-                pad_y_top = 0
-                if y_top < 0:
-                    pad_y_top = -y_top
-                    y_top = 0
-                pad_y_bottom = 0
-                if y_bottom >= img_height:
-                    pad_y_bottom = y_bottom - img_height + 1
-                    y_bottom = img_height - 1
-
                 # Padding the image and resize the image
-                processed_image = np.pad(img[y_top:y_bottom + 1, x_left:x_right + 1],
-                                         ((pad_y_top, pad_y_bottom), (pad_x_left, pad_x_right), (0, 0)),
-                                         mode='edge')
-                processed_image = cv2.resize(processed_image, (self.img_size_w, self.img_size_h))
+                img = np.pad(img[y_top:y_bottom + 1, x_left:x_right + 1],
+                             ((pad_y_top, pad_y_bottom), (pad_x_left, pad_x_right), (0, 0)),
+                             mode='edge')
             else:
-                if img_height > self.crop_size_h and img_width > self.crop_size_w:
-                    x_left = int(img_width - self.crop_size_w) // 2
-                    x_right = int(x_left + self.crop_size_w)
-                    y_top = int(img_height - self.crop_size_h) // 2
-                    y_bottom = int(y_top + self.crop_size_h)
-                else:
-                    x_left = 0
-                    x_right = img_width
-                    y_top = 0
-                    y_bottom = img_height
-
-                processed_image = cv2.resize(img[y_top:y_bottom, x_left:x_right], (self.img_size_w, self.img_size_h))
+                img = img[y_top:y_bottom, x_left:x_right]
+            cv2.resize(img, (self.img_size_w, self.img_size_h), dst=processed_images[img_idx])
 
-            processed_images = np.append(processed_images, [processed_image], axis=0)
         return processed_images
 
 
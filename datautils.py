@@ -1,8 +1,8 @@
 # datautils.py : linear psd loading/rendering utils and basic augmentations
-import random
 import io
 import os
 import pickle
+import zlib
 from PIL import Image, ImageOps
 import numpy as np
 import cv2
@@ -15,96 +15,158 @@ from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms
 import torchvision.transforms.functional as TF
 from matplotlib import pyplot as plt
-from multiprocessing import Pool
+import multiprocessing as mp
+try:
+    import numba
+except ImportError:
+    numba = None
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
 
 import data_transforms as data_transforms
 
 
+class LayerBatch(object):
+    # struct-of-arrays layer stack: per-layer attributes live in flat arrays so
+    # visibility filters and blend mode lookups are single vectorized ops
+    def __init__(self, names, images, opacity, visible, blend_mode, is_clip):
+        self.names = list(names)
+        self.images = images
+        self.opacity = np.asarray(opacity, dtype=np.uint8)
+        self.visible = np.asarray(visible, dtype=bool)
+        self.blend_mode = np.asarray(blend_mode, dtype=np.uint8)
+        self.is_clip = np.asarray(is_clip, dtype=bool)
+
+    def __len__(self):
+        return len(self.names)
+
+
+def blend_code(blend_mode):
+    # maps a psd_tools blend mode to its BLEND_DICT code, unsupported modes composite as padding
+    if isinstance(blend_mode, BlendMode):
+        return BLEND_DICT.get(blend_mode, BLEND_DICT[b'padding'])
+    return blend_mode
+
+
 def psd2pil(psd):
-    # converts psd layers into pil list for augmentation
-    layers = []
+    # converts psd layers into a LayerBatch of pil images for augmentation, pil2tensor takes it as is
+    names, images, opacity, visible, blend_mode, is_clip = [], [], [], [], [], []
     width, height = psd.width, psd.height
 
     def pad_to_canvas(layer):
         x1, y1, x2, y2 = layer.bbox
         return ImageOps.expand(layer.topil(), border=(x1, y1, width - x2, height - y2), fill=0)
 
+    def add_layer(layer, clip):
+        layer_img = pad_to_canvas(layer)
+        if layer_img.getbbox() is None:  # filter empty layers
+            return False
+        names.append(layer.name)
+        images.append(layer_img)
+        opacity.append(layer.opacity)
+        visible.append(layer.visible)
+        blend_mode.append(blend_code(layer.blend_mode))
+        is_clip.append(clip)
+        return True
+
     for i, layer in enumerate(psd):
         if layer.size[0] == 0 or layer.size[1] == 0:
             continue
-        layer_img = pad_to_canvas(layer)
-        if layer_img.getbbox() is None:  # filter empty layers
+        if not add_layer(layer, False):
             continue
-        layers.append([layer.name, layer_img, layer.opacity, layer.visible, layer.blend_mode, False])
-        if len(layer.clip_layers):
-            for clip in layer.clip_layers:
-                clip_img = pad_to_canvas(clip)
-                if clip_img.getbbox() is None:
+        for clip in layer.clip_layers:
+            add_layer(clip, True)
+
+    return LayerBatch(names, images, opacity, visible, blend_mode, is_clip)
+
+
+if numba is not None:
+    # serial on purpose: this runs inside dataloader workers, which already parallelize
+    @numba.njit(fastmath=True, cache=True)
+    def remove_occluded_pixels(imgs, is_normal):
+        # zeroes normal layer pixels once any normal layer above them is opaque there,
+        # one fused pass per row keeps the coverage mask in cache
+        l, h, w, c = imgs.shape
+        for y in range(h):
+            covered = np.zeros(w, dtype=np.bool_)
+            for i in range(l - 1, -1, -1):
+                if not is_normal[i]:
                     continue
-                layers.append([clip.name, clip_img, clip.opacity, clip.visible, clip.blend_mode, True])
-
-    return layers
+                for x in range(w):
+                    if covered[x]:
+                        imgs[i, y, x, :] = 0
+                    elif imgs[i, y, x, 3] == 1:
+                        covered[x] = True
+
+    # compile at import rather than inside the first dataloader call
+    remove_occluded_pixels(np.zeros((1, 1, 1, 4), dtype=np.float32), np.zeros(1, dtype=np.bool_))
+else:
+    def remove_occluded_pixels(imgs, is_normal):
+        # a normal layer pixel is occluded once any normal layer above it is opaque there
+        opaque = (imgs[:, :, :, 3] == 1) & is_normal[:, None, None]
+        covered = np.logical_or.accumulate(opaque[::-1], axis=0)[::-1]
+        occluded = np.zeros_like(opaque)
+        occluded[:-1] = covered[1:] & is_normal[:-1, None, None]
+        imgs[occluded] = 0
 
 
 def pil2tensor(data, layer_tensor_filter=None, remove_occluded=False):
-    # converts pil list to tensors, normalize opacity, removes occluded pixels
+    # converts a LayerBatch of pil images or uint8 arrays to an (L, H, W, C) float stack,
+    # normalize opacity, removes occluded pixels
     layers = data['layers']
-    preview = np.array(data['preview']).astype(np.float32) / 255.0
-    for i in range(len(layers)):
-        if layers[i][1].getbbox() is not None and layers[i][2] > 0 and layers[i][3]:
-            layers[i][1] = np.array(layers[i][1]).astype(np.float32) / 255.0
-            if layers[i][1].shape[2] > 3:
-                layers[i][1][:, :, 3] *= layers[i][2] / 255.0
-        else:
-            # remove invisible or 100% transparent layers
-            layers[i][1] = None
-
-    layer_tensors = []
-    cur_layer_img = None
-    for name, img, opacity, visible, blend_mode, is_clip in layers:
-        if img is None:
-            continue
-        if cur_layer_img is None or not is_clip:
-            cur_layer_img = img
-        if is_clip:
-            img[:, :, 3] *= cur_layer_img[:, :, 3]
-            img[img[:, :, 3] == 0] = 0
-        layer_tensors.append((img, blend_mode))
+    preview = np.divide(np.asarray(data['preview']), np.float32(255.0), dtype=np.float32)
+    # remove invisible or 100% transparent layers
+    keep = np.flatnonzero(layers.visible & (layers.opacity > 0))
+    images = {i: np.asarray(layers.images[i]) for i in keep}
+    keep = np.array([i for i in keep if images[i].shape[2] < 4 or images[i][:, :, 3].any()], dtype=np.int64)
+    blend_modes = layers.blend_mode[keep]
+
+    # decode every layer into one stacked float buffer
+    h, w, c = images[keep[0]].shape if len(keep) else preview.shape[:2] + (4,)
+    imgs = np.empty((len(keep), h, w, c), dtype=np.float32)
+    for i, j in enumerate(keep):
+        np.divide(images[j], np.float32(255.0), out=imgs[i], dtype=np.float32)
+
+    if c > 3:
+        imgs[:, :, :, 3] *= (layers.opacity[keep].astype(np.float32) / 255.0)[:, None, None]
+
+        # clipping layers are masked by the alpha of the closest base layer below them
+        is_clip = layers.is_clip[keep]
+        if is_clip.any():
+            idx = np.arange(len(keep))
+            base = np.maximum.accumulate(np.where(is_clip, -1, idx))
+            base = np.where(base < 0, idx, base)
+            imgs[is_clip, :, :, 3] *= imgs[base[is_clip], :, :, 3]
+            imgs[(imgs[:, :, :, 3] == 0) & is_clip[:, None, None]] = 0
 
     if layer_tensor_filter is not None:
-        layer_tensors = layer_tensor_filter(layer_tensors, preview)
-
-    if remove_occluded:
-        h, w, c = layer_tensors[0][0].shape
-        mask = np.zeros((h, w), dtype=np.uint8)
-        for img, blend_mode in reversed(layer_tensors):
-            if blend_mode != BlendMode.NORMAL:
-                continue
-            img[mask == 1] = 0
-            if img.shape[2] > 3:
-                mask[img[:, :, 3] == 1] = 1
-
-    return layer_tensors, preview
-
-
-# drops out full layers
-def drop_full_post_filter(layer_tensors, preview):
-    tmp = []
-    for img, blend_mode in layer_tensors:
-        tmp.append(img)
-    t = np.stack(tmp)
+        keep = np.flatnonzero(layer_tensor_filter(imgs, blend_modes, preview))
+        if len(keep) < len(imgs):
+            # compact the kept layers to the front of the buffer in place
+            for i, j in enumerate(keep):
+                if i != j:
+                    imgs[i] = imgs[j]
+            imgs, blend_modes = imgs[:len(keep)], blend_modes[keep]
+
+    if remove_occluded and c > 3:
+        remove_occluded_pixels(imgs, blend_modes == BLEND_DICT[BlendMode.NORMAL])
+
+    return imgs, blend_modes, preview
+
+
+# drops out full layers, post filters return a boolean keep mask over the (L, H, W, C) layer stack
+def drop_full_post_filter(imgs, blend_modes, preview):
     p = np.mean(preview[:, :, 3])
-    t = np.mean(t[:, :, :, 3], axis=(1, 2)) / p
-    ret = []
-    for i, (img, blend_mode) in enumerate(layer_tensors):
-        if (t[i] > 0.95 and i > len(layer_tensors) - 2) or t[i] < 1e-5:
-            continue
-        ret.append((img, blend_mode))
-    return ret
+    t = np.mean(imgs[:, :, :, 3], axis=(1, 2)) / p
+    is_top = np.arange(len(imgs)) > len(imgs) - 2
+    return ~(((t > 0.95) & is_top) | (t < 1e-5))
 
 
-def default_post_filter(layer_tensors, preview):
-    return layer_tensors
+def default_post_filter(imgs, blend_modes, preview):
+    return np.ones(len(imgs), dtype=bool)
 
 
 def image_to_byte_array(image):
@@ -114,13 +176,56 @@ def image_to_byte_array(image):
     return imgByteArr
 
 
-def load_from_pickle(path):
-    f = open(path, 'rb')
-    data = pickle.load(f)
-    data['preview'] = Image.open(io.BytesIO(data['preview']))
-    for i in range(len(data['layers'])):
-        data['layers'][i][1] = Image.open(io.BytesIO(data['layers'][i][1]))
-    f.close()
+def array_to_byte_array(arr):
+    # raw uint8 pixels behind fast zlib level 1, files are larger than png on disk
+    # but loading skips the png codec
+    return zlib.compress(np.ascontiguousarray(arr, dtype=np.uint8).tobytes(), 1)
+
+
+def byte_array_to_array(byte_array, shape):
+    return np.frombuffer(zlib.decompress(byte_array), dtype=np.uint8).reshape(shape)
+
+
+def png_to_array(byte_array, mode=None):
+    img = Image.open(io.BytesIO(byte_array))
+    return np.asarray(img if mode is None else img.convert(mode))
+
+
+def load_from_pickle(path, layers=True):
+    # returns the preview as a uint8 array and, with layers, a LayerBatch whose shown layers are
+    # decoded to uint8 arrays, hidden layers stay None and are never inflated
+    with open(path, 'rb', buffering=1 << 20) as f:
+        data = pickle.load(f)
+    if 'blend_mode' not in data:
+        # older pickles keep one [name, png, opacity, visible, blend_mode, is_clip] list per layer
+        legacy = data['layers']
+        data['names'] = [layer[0] for layer in legacy]
+        data['layers'] = [layer[1] for layer in legacy]
+        data['opacity'] = [layer[2] for layer in legacy]
+        data['visible'] = [layer[3] for layer in legacy]
+        data['blend_mode'] = [blend_code(layer[4]) for layer in legacy]
+        data['is_clip'] = [layer[5] for layer in legacy]
+    raw = 'layer_shape' in data
+    if raw:
+        data['preview'] = byte_array_to_array(data['preview'], data.pop('preview_shape'))
+    else:
+        # older pickles store png encoded images
+        data['preview'] = png_to_array(data['preview'])
+    if not layers:
+        data['layers'] = None
+        return data
+
+    shown = np.asarray(data['visible'], dtype=bool) & (np.asarray(data['opacity']) > 0)
+    images = []
+    for layer, show in zip(data['layers'], shown):
+        if not show:
+            images.append(None)
+        elif raw:
+            images.append(byte_array_to_array(layer, data['layer_shape']))
+        else:
+            images.append(png_to_array(layer, 'RGBA'))
+    data['layers'] = LayerBatch(data.pop('names'), images, data.pop('opacity'), data.pop('visible'),
+                                data.pop('blend_mode'), data.pop('is_clip'))
     return data
 
 
@@ -136,6 +241,27 @@ BLEND_DICT = {
     b'padding': 4
 }
 
+# transforms within 5e-3 of identity per element are treated as identity
+EYE3 = np.eye(3, dtype=np.float32)
+
+# one-hot rows per blend code, padding layers also composite as normal
+ONE_HOT_BM = np.eye(len(BLEND_DICT), dtype=np.float32)
+ONE_HOT_BM[BLEND_DICT[b'padding'], BLEND_DICT[BlendMode.NORMAL]] = 1
+
+
+def load_aligned_preview(path, warp, resize_to_final):
+    # uint8 preview aligned with its own transform to the finishing size
+    sample = load_from_pickle(path, layers=False)
+    M = np.array(sample['transform'])
+    final_width, final_height = sample['finishing_size']
+    preview = sample['preview']
+    h, w = preview.shape[:2]
+    if warp and np.abs(M - EYE3).max() > 5e-3:
+        preview = cv2.warpPerspective(preview, M, (final_width, final_height), flags=cv2.INTER_LINEAR)
+    elif resize_to_final and (w != final_width or h != final_height):
+        preview = cv2.resize(preview, (final_width, final_height), interpolation=cv2.INTER_AREA)
+    return preview
+
 
 class PSDPickleDataset(Dataset):
     # ./root_dir
@@ -162,63 +288,47 @@ class PSDPickleDataset(Dataset):
         sample = load_from_pickle(path)
         M = np.array(sample['transform'])
         final_width, final_height = sample['finishing_size']
-        w, h = sample['preview'].size
-        if warp and np.linalg.norm(M - np.eye(3)) > 5e-3:
-            warped_layers = []
-            for name, x, opacity, visible, blend_mode, is_clip in sample['layers']:
-                x = np.array(x, dtype=np.float32)
-                x = cv2.warpPerspective(x, M, (final_width, final_height))
-                x = Image.fromarray(x.astype(np.uint8))
-                warped_layers.append([name, x, opacity, visible, blend_mode, is_clip])
-            sample['layers'] = warped_layers
+        h, w = sample['preview'].shape[:2]
+        layers = sample['layers']
+        if warp and np.abs(M - EYE3).max() > 5e-3:
+            # warp the uint8 pixels directly, float conversion happens once in pil2tensor
+            layers.images = [None if x is None else
+                             cv2.warpPerspective(x, M, (final_width, final_height), flags=cv2.INTER_LINEAR)
+                             for x in layers.images]
         elif resize_to_final and (w != final_width or h != final_height):
-            for i in range(len(sample['layers'])):
-                sample['layers'][i][1] = sample['layers'][i][1].resize((final_width, final_height), Image.ANTIALIAS)
-
-        layers, preview = pil2tensor(sample, self.post_filter, remove_occluded)
-        tensors, blend_modes = [], []
-        for layer, blend_mode in layers:
-            tensors.append(layer)
-            blend_modes.append(blend_mode)
-        while len(tensors) > self.max_layers:
-            idx = random.randint(0, len(tensors) - 1)
-            del tensors[idx]
-            del blend_modes[idx]
-        tensors = np.stack(tensors)
-        l, h, w, c = tensors.shape
-        blend_modes = np.array([BLEND_DICT[i] for i in blend_modes], dtype=np.uint8)
-        if len(tensors) < self.max_layers:
-            padding = np.zeros((self.max_layers - len(tensors), h, w, c), dtype=np.float32)
-            blend_padding = np.ones(self.max_layers - len(tensors), dtype=np.uint8) * BLEND_DICT[b'padding']
-            blend_modes = np.concatenate((blend_padding, blend_modes))
-            tensors = np.concatenate((padding, tensors))
+            layers.images = [None if x is None else
+                             cv2.resize(x, (final_width, final_height), interpolation=cv2.INTER_AREA)
+                             for x in layers.images]
+
+        layers, layer_bm, preview = pil2tensor(sample, self.post_filter, remove_occluded)
+        keep = np.arange(len(layers))
+        if len(keep) > self.max_layers:
+            # randomly drop the surplus layers, keeping the survivors in stacking order
+            keep = np.sort(np.random.choice(len(keep), self.max_layers, replace=False))
+        # gather layers straight into their slots of the padded stack, padding goes first
+        l, h, w, c = layers.shape
+        offset = self.max_layers - len(keep)
+        tensors = np.zeros((self.max_layers, h, w, c), dtype=np.float32)
+        blend_modes = np.full((self.max_layers,), BLEND_DICT[b'padding'], dtype=np.uint8)
+        np.take(layers, keep, axis=0, out=tensors[offset:], mode='clip')
+        blend_modes[offset:] = layer_bm[keep]
         if self.transform is not None:
             tensors = self.transform(tensors)
-        one_hot_bm = np.identity(len(BLEND_DICT))[blend_modes]
-        one_hot_bm[one_hot_bm[:, BLEND_DICT[b'padding']] == 1, BLEND_DICT[BlendMode.NORMAL]] = 1
+        if isinstance(tensors, np.ndarray):
+            tensors = torch.from_numpy(tensors)
+        one_hot_bm = torch.from_numpy(ONE_HOT_BM[blend_modes])
         return tensors, one_hot_bm, len(sample['layers'])
 
     def load_preview_data(self, paths, warp, resize_to_final):
-        previews = []
-        for path in paths:
-            sample = load_from_pickle(path)
-            M = np.array(sample['transform'])
-            final_width, final_height = sample['finishing_size']
-            preview = sample['preview']
-            previews.append(preview)
-
-        for i, preview in enumerate(previews):
-            w, h = preview.size
-            if warp and np.linalg.norm(M - np.eye(3)) > 5e-3:
-                preview = np.array(preview).astype(np.float32)
-                preview = cv2.warpPerspective(preview, M, (final_width, final_height))
-                preview = Image.fromarray(preview.astype(np.uint8))
-            elif resize_to_final and (w != final_width or h != final_height):
-                preview = preview.resize((final_width, final_height), Image.ANTIALIAS)
-            preview = np.array(preview).astype(np.float32) / 255.
-            previews[i] = preview[:, :, :3]
-
-        previews = np.stack(previews)
+        previews = None
+        for i, path in enumerate(paths):
+            # random augmentation is applied below, on top of the aligned preview
+            preview = load_aligned_preview(path, warp, resize_to_final)[:, :, :3]
+            if previews is None:
+                previews = np.empty((len(paths),) + preview.shape, dtype=np.float32)
+            # cast and scale in one pass, straight into the stacked output
+            np.divide(preview, np.float32(255.0), out=previews[i], dtype=np.float32)
+
         if self.transform is not None:
             previews = self.transform(previews)
 
@@ -285,38 +395,36 @@ class PSDImageDataset(PSDPickleDataset):
         return preview
 
 
-def psd2pickle(psd, save_path, attrs={}):
+def psd2pickle(psd, save_path, attrs={}, composite=None):
+    # composite: already rendered psd.composite() to reuse as the preview
     layers = psd2pil(psd)
-    preview =  image_to_byte_array(psd.composite())
-    save_layers = []
-    for name, img, opacity, visible, blend_mode, is_clip in layers:
-        save_layers.append([name, image_to_byte_array(img), opacity, visible, blend_mode, is_clip])
+    preview = np.asarray(psd.composite() if composite is None else composite)
+    # per-layer attributes are stored as ready-to-use arrays, blend modes as BLEND_DICT codes
     data = {
-        'preview': preview,
-        'layers': save_layers
+        'preview': array_to_byte_array(preview),
+        'preview_shape': preview.shape,
+        'names': layers.names,
+        'layers': [array_to_byte_array(img.convert('RGBA')) for img in layers.images],
+        'layer_shape': (psd.height, psd.width, 4),
+        'opacity': layers.opacity,
+        'visible': layers.visible,
+        'blend_mode': layers.blend_mode,
+        'is_clip': layers.is_clip
     }
     data.update(attrs)
-    f = open(save_path, 'wb')
-    pickle.dump(data, f)
-    f.close()
+    with open(save_path, 'wb', buffering=1 << 20) as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 def iou(boxA, boxB):
-    xA = max(boxA[0], boxB[0])
-    yA = max(boxA[1], boxB[1])
-    xB = min(boxA[2], boxB[2])
-    yB = min(boxA[3], boxB[3])
-
-    interArea = abs(max((xB - xA, 0)) * max((yB - yA), 0))
-    if interArea == 0:
-        return 0
-
-    boxAArea = abs((boxA[2] - boxA[0]) * (boxA[3] - boxA[1]))
-    boxBArea = abs((boxB[2] - boxB[0]) * (boxB[3] - boxB[1]))
-
-    iou = interArea / float(boxAArea + boxBArea - interArea)
-
-    return iou
+    # boxes are [..., 4] arrays of [x1, y1, x2, y2]
+    boxA, boxB = np.asarray(boxA, dtype=np.float32), np.asarray(boxB, dtype=np.float32)
+    top_left = np.maximum(boxA[..., :2], boxB[..., :2])
+    bottom_right = np.minimum(boxA[..., 2:], boxB[..., 2:])
+    interArea = np.prod(np.clip(bottom_right - top_left, 0, None), axis=-1)
+    boxAArea = np.abs(np.prod(boxA[..., 2:] - boxA[..., :2], axis=-1))
+    boxBArea = np.abs(np.prod(boxB[..., 2:] - boxB[..., :2], axis=-1))
+    return interArea / (boxAArea + boxBArea - interArea + 1e-12)
 
 
 def dataset_psd2pkl_worker(args):
@@ -346,41 +454,42 @@ def dataset_psd2pkl_worker(args):
     M = np.eye(3, dtype=np.float32)
     final_width, final_height = reference.size
 
-    reference_img = np.array(ImageOps.grayscale(reference.composite()))
+    composite = reference.composite()
+    reference_img = np.array(ImageOps.grayscale(composite))
     MIN_MATCH_COUNT = 10
     ltol, rtol = 5e-3, 200
-    eye = np.eye(3, dtype=np.float32)
-    psd2pickle(reference, pkl_path, {'finishing_size': [final_width, final_height], 'transform': M.tolist()})
+    psd2pickle(reference, pkl_path, {'finishing_size': [final_width, final_height], 'transform': M.tolist()},
+               composite)
     if delete_psd:
         os.remove(psd_path)
 
     if len(files) == 0:
         return
 
+    if len(files) > 1:
+        # detector and matcher are shared by all frames, descriptors of the previous frame are reused
+        sift = cv2.SIFT_create()
+        FLANN_INDEX_KDTREE = 0
+        index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
+        search_params = dict(checks = 50)
+        flann = cv2.FlannBasedMatcher(index_params, search_params)
+        kp_ref, des_ref = sift.detectAndCompute(reference_img, None)
+
     for f in files[1:]:
         name = f.split('.')[0]
         psd_path = os.path.join(path, f)
         pkl_path = os.path.join(path, name + '.pkl')
         current = PSDImage.open(psd_path)
         w, h = current.size
-        current_img = np.array(ImageOps.grayscale(current.composite()))
-
-        # Initiate SIFT detector
-        sift = cv2.SIFT_create()
+        composite = current.composite()
+        current_img = np.array(ImageOps.grayscale(composite))
 
         # find the keypoints and descriptors with SIFT
         kp1, des1 = sift.detectAndCompute(current_img, None)
-        kp2, des2 = sift.detectAndCompute(reference_img, None)
-        FLANN_INDEX_KDTREE = 0
-        index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
-        search_params = dict(checks = 50)
-
-        flann = cv2.FlannBasedMatcher(index_params, search_params)
-        if des1.shape[0] > 1000 and des2.shape[0] > 1000:
-            des1 = des1[:1000]
-            des2 = des2[:1000]
+        kp2, des2 = kp_ref, des_ref
         if des1 is not None and des2 is not None and des1.shape[0] >= 2 and des2.shape[0] >= 2:
-            matches = flann.knnMatch(des1,des2,k=2)
+            n_des = 1000 if des1.shape[0] > 1000 and des2.shape[0] > 1000 else None
+            matches = flann.knnMatch(des1[:n_des],des2[:n_des],k=2)
         else:
             matches = []
 
@@ -403,7 +512,7 @@ def dataset_psd2pkl_worker(args):
             perspective = np.eye(3)
         
         M = M @ perspective
-        if np.linalg.norm(M - eye) < ltol:
+        if np.abs(M - EYE3).max() < ltol:
             M = np.eye(3)
         else:
             src_rect = np.float32([ [0,0],[0,h-1],[w-1,h-1],[w-1,0] ]).reshape(-1,1,2)
@@ -419,8 +528,9 @@ def dataset_psd2pkl_worker(args):
 
         # aligned = cv2.warpPerspective(current_img, M, (final_width, final_height))
         # cv2.imwrite(os.path.join(path, name + '.png'), aligned)
-        reference_img = np.copy(current_img)
-        psd2pickle(PSDImage.open(psd_path), pkl_path, {'finishing_size': [final_width, final_height], 'transform': M.tolist()})
+        kp_ref, des_ref = kp1, des1
+        psd2pickle(current, pkl_path, {'finishing_size': [final_width, final_height], 'transform': M.tolist()},
+                   composite)
         if delete_psd:
             os.remove(psd_path)
 
@@ -430,8 +540,14 @@ def dataset_psd2pkl_worker(args):
 def dataset_psd2pkl(root_dir, n_processes=16, delete_psd=False):
     # converts whole dataset into pkl
     args = [(root, files, delete_psd) for root, dirs, files in os.walk(root_dir)]
-    with Pool(n_processes) as p:
-        p.map(dataset_psd2pkl_worker, args)
+    # forkserver children start clean, recycling them bounds opencv / pillow memory creep,
+    # platforms without forkserver (windows) keep their default start method
+    ctx = mp.get_context('forkserver' if 'forkserver' in mp.get_all_start_methods() else None)
+    # small chunks so each child actually reaches maxtasksperchild and gets recycled
+    chunksize = min(max(1, len(args) // (4 * n_processes)), 4)
+    with ctx.Pool(n_processes, maxtasksperchild=32) as p:
+        for _ in p.imap_unordered(dataset_psd2pkl_worker, args, chunksize=chunksize):
+            pass
 
 
 def LinearComposite(tensors, blend_modes, background=1):
@@ -439,19 +555,141 @@ def LinearComposite(tensors, blend_modes, background=1):
     b, max_layers, c, h, w = tensors.shape
     b, max_layers, n_modes = blend_modes.shape
     blend_modes = blend_modes.view((b, max_layers, n_modes, 1, 1, 1))
-    ret = torch.ones((b, 3, h, w), dtype=torch.float32).to(tensors.device) * background
+    ret = torch.full((b, 3, h, w), background, dtype=torch.float32, device=tensors.device)
     for i in range(max_layers):
-        alpha = tensors[:, i, 3:, :, :].contiguous()
-        src = tensors[:, i, :3, :, :].contiguous()
-        src_alpha = src * alpha
+        alpha = tensors[:, i, 3:, :, :]
+        src_alpha = tensors[:, i, :3, :, :] * alpha
+        shaded_base = (1.0 - alpha) * ret
+        # accumulate each mode's contribution by its one-hot weight instead of
+        # materializing all four blendings with torch.stack
+        bm = blend_modes[:, i]
+        ret = bm[:, 0] * (src_alpha + shaded_base) \
+            + bm[:, 1] * (src_alpha * ret + shaded_base) \
+            + bm[:, 2] * (src_alpha + ret).clamp(0.0, 1.0) \
+            + bm[:, 3] * (1.0 - (1.0 - ret) * (1.0 - src_alpha))
+    return ret
+
+
+# fuses the per-layer elementwise chain into one kernel per iteration on torch >= 2.0
+if hasattr(torch, 'compile'):
+    CompiledLinearComposite = torch.compile(LinearComposite, fullgraph=False, dynamic=False)
+else:
+    CompiledLinearComposite = LinearComposite
+
+
+if triton is not None:
+    @triton.jit
+    def blend_channel(ret, src_alpha, alpha, code):
         shaded_base = (1.0 - alpha) * ret
         normal = src_alpha + shaded_base
         multiply = src_alpha * ret + shaded_base
-        linear_dodge = (src_alpha + ret).clamp(0.0, 1.0)
+        linear_dodge = tl.minimum(tl.maximum(src_alpha + ret, 0.0), 1.0)
         screen = 1.0 - (1.0 - ret) * (1.0 - src_alpha)
-        blendings = torch.stack((normal, multiply, linear_dodge, screen), 1)
-        ret = torch.sum(blend_modes[:, i, :BLEND_DICT[b'padding'], :, :, :] * blendings, 1)
-    return ret
+        return tl.where(code == 0, normal, tl.where(code == 1, multiply, tl.where(code == 2, linear_dodge, screen)))
+
+    @triton.jit
+    def linear_composite_kernel(ret_ptr, tensors_ptr, codes_ptr, n_layers, n_channels, hw, background,
+                                BLOCK: tl.constexpr):
+        # one program runs a tile of pixels of one sample through every layer,
+        # the running composite stays in registers
+        b = tl.program_id(0).to(tl.int64)
+        offs = tl.program_id(1) * BLOCK + tl.arange(0, BLOCK)
+        mask = offs < hw
+        r = tl.zeros((BLOCK,), dtype=tl.float32) + background
+        g = tl.zeros((BLOCK,), dtype=tl.float32) + background
+        bl = tl.zeros((BLOCK,), dtype=tl.float32) + background
+        for i in range(n_layers):
+            code = tl.load(codes_ptr + b * n_layers + i)
+            layer_ptr = tensors_ptr + (b * n_layers + i) * n_channels * hw + offs
+            alpha = tl.load(layer_ptr + 3 * hw, mask=mask, other=0.0)
+            r = blend_channel(r, tl.load(layer_ptr, mask=mask, other=0.0) * alpha, alpha, code)
+            g = blend_channel(g, tl.load(layer_ptr + hw, mask=mask, other=0.0) * alpha, alpha, code)
+            bl = blend_channel(bl, tl.load(layer_ptr + 2 * hw, mask=mask, other=0.0) * alpha, alpha, code)
+        ret_ptr += b * 3 * hw + offs
+        tl.store(ret_ptr, r, mask=mask)
+        tl.store(ret_ptr + hw, g, mask=mask)
+        tl.store(ret_ptr + 2 * hw, bl, mask=mask)
+
+
+class LinearCompositeFunction(torch.autograd.Function):
+    # triton forward, backward recomputes LinearComposite instead of keeping per-layer intermediates
+    @staticmethod
+    def forward(ctx, tensors, blend_modes, background):
+        ctx.save_for_backward(tensors, blend_modes)
+        ctx.background = background
+        b, max_layers, c, h, w = tensors.shape
+        assert c >= 4, 'layers need rgb and alpha channels, got %d channels' % c
+        # padding rows are also marked normal, so the argmax over real modes maps them to normal,
+        # soft weights would composite differently from the LinearComposite the backward differentiates
+        real_modes = blend_modes[:, :, :BLEND_DICT[b'padding']]
+        assert bool((((real_modes == 0) | (real_modes == 1)).all() & (real_modes.sum(-1) == 1).all()).item()), \
+            'FusedLinearComposite needs one-hot blend modes, use LinearComposite for soft weights'
+        codes = real_modes.argmax(-1).to(torch.int32).contiguous()
+        ret = torch.empty((b, 3, h, w), dtype=torch.float32, device=tensors.device)
+        BLOCK = 1024
+        grid = (b, triton.cdiv(h * w, BLOCK))
+        linear_composite_kernel[grid](ret, tensors.float().contiguous(), codes, max_layers, c, h * w,
+                                      float(background), BLOCK=BLOCK)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        tensors, blend_modes = ctx.saved_tensors
+        needs_grad = ctx.needs_input_grad[:2]
+        with torch.enable_grad():
+            inputs = [x.detach().requires_grad_(need) for x, need in zip((tensors, blend_modes), needs_grad)]
+            ret = LinearComposite(inputs[0], inputs[1], ctx.background)
+        grads = iter(torch.autograd.grad(ret, [x for x in inputs if x.requires_grad], grad_output))
+        return tuple(next(grads) if need else None for need in needs_grad) + (None,)
+
+
+def FusedLinearComposite(tensors, blend_modes, background=1):
+    # single-kernel LinearComposite for one-hot blend modes on cuda, falls back to the layer loop
+    if triton is None or not tensors.is_cuda:
+        return LinearComposite(tensors, blend_modes, background)
+    return LinearCompositeFunction.apply(tensors, blend_modes, background)
+
+
+def test_legacy_pickle():
+    # legacy per-layer pickles must respect layers=False and never touch the layer blobs
+    import tempfile
+    preview = image_to_byte_array(Image.new('RGBA', (4, 3)))
+    legacy = [['bad', b'not a png', 255, True, BlendMode.NORMAL, False]]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'legacy.pkl')
+        with open(path, 'wb') as f:
+            pickle.dump({'preview': preview, 'layers': legacy}, f)
+        sample = load_from_pickle(path, layers=False)
+        assert sample['layers'] is None and sample['preview'].shape == (3, 4, 4)
+
+        with open(path, 'wb') as f:
+            pickle.dump({'preview': preview, 'layers': []}, f)
+        sample = load_from_pickle(path)
+        assert isinstance(sample['layers'], LayerBatch) and len(sample['layers']) == 0
+    print('test_legacy_pickle passed')
+
+
+def test_fused_composite(b=2, max_layers=8, h=37, w=53, atol=1e-5):
+    # compares FusedLinearComposite against LinearComposite on random one-hot blend modes
+    if triton is None or not torch.cuda.is_available():
+        print('test_fused_composite skipped, needs triton and cuda')
+        return
+    for c in (4, 5):
+        tensors = torch.rand((b, max_layers, c, h, w), device='cuda')
+        codes = torch.randint(0, len(BLEND_DICT), (b, max_layers))
+        blend_modes = torch.from_numpy(ONE_HOT_BM)[codes].cuda()
+        expected = LinearComposite(tensors, blend_modes, background=0.5)
+        result = FusedLinearComposite(tensors, blend_modes, background=0.5)
+        err = (result - expected).abs().max().item()
+        assert err < atol, 'fused composite differs by %g with %d channels' % (err, c)
+
+        tensors.requires_grad_(True)
+        FusedLinearComposite(tensors, blend_modes, background=0.5).sum().backward()
+        grad_fused = tensors.grad
+        tensors.grad = None
+        LinearComposite(tensors, blend_modes, background=0.5).sum().backward()
+        assert torch.allclose(grad_fused, tensors.grad, atol=atol)
+        print('test_fused_composite channels %d max abs error %g' % (c, err))
 
 
 def test_loader():
@@ -465,7 +703,7 @@ def test_loader():
     # dataset = PSDPickleDataset('/home/ubuntu/nvme/dataset/figures', max_layers=ml, transform=train_transforms, post_filter=drop_full_post_filter)
 
     # tensors, bm, _ = dataset.load_pkl_data('/home/ubuntu/nvme/dataset/figures/34b447c5f9ae4d4b858475eacd09ce38/4.pkl', False, True, False)
-    # tensors, bm = torch.tensor(tensors).unsqueeze(0), torch.tensor(bm).unsqueeze(0)
+    # tensors, bm = tensors.unsqueeze(0), bm.unsqueeze(0)
     # res = LinearComposite(tensors, bm, background=0.5)
     # print(bm)
     # print(res.shape)